@@ -60,6 +60,7 @@ with st.sidebar:
         st.rerun()
 
     st.markdown("---")
+    branch_id = st.text_input("Branch", value="main")
     st.caption("Each session has its own conversation independent from the others.")
 
 
@@ -83,10 +84,28 @@ if user_input:
             "message": user_input,
             "session_id": current_id,  
         }
-        resp = requests.post(f"{API_BASE}/chat", json=payload, timeout=60)
-        resp.raise_for_status()
-        data = resp.json()
-        reply = data.get("reply", "(No reply)")
+        # the same key is reused on retry, so the server replays the first
+        # result instead of running the agent (and its orders) twice
+        headers = {
+            "Idempotency-Key": str(uuid.uuid4()),
+            "X-Branch-Id": branch_id,
+        }
+        for attempt in range(2):
+            try:
+                resp = requests.post(
+                    f"{API_BASE}/chat", json=payload, headers=headers, timeout=60
+                )
+                break
+            except requests.Timeout:
+                if attempt == 1:
+                    raise
+        if resp.status_code in (409, 422):
+            # Idempotency-Key conflict: the server explains it in "error"
+            reply = resp.json().get("error", "(No reply)")
+        else:
+            resp.raise_for_status()
+            data = resp.json()
+            reply = data.get("reply", "(No reply)")
     except Exception as e:
         reply = f"An error occurred while communicating with the server: {e}"
 
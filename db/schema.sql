@@ -50,3 +50,14 @@ CREATE TABLE IF NOT EXISTS tool_calls (
   result_json TEXT NOT NULL,
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  endpoint TEXT NOT NULL,
+  key TEXT NOT NULL,
+  request_hash TEXT NOT NULL,
+  response_json TEXT,
+  created_at REAL NOT NULL,
+  expires_at REAL NOT NULL,
+  PRIMARY KEY (endpoint, key)
+);
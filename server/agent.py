@@ -1,10 +1,15 @@
+import asyncio
+import time
 from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import tool
 from langchain.agents import create_tool_calling_agent, AgentExecutor
-from db_messages import save_message, save_tool_call
+import metrics
+from config import AGENT_MAX_SECONDS, AGENT_MAX_STEPS
+from db_messages import save_message, save_tool_call, asave_message, asave_tool_call
+from idempotency import mark_written
 from sqlalchemy.orm import Session
 
 from db import (
@@ -15,30 +20,44 @@ from db import (
     update_price_db,
     order_status_db,
     inventory_summary_db,
+    stock_across_branches_db,
 )
+import db_async as adb
+from db_async import AsyncSessionLocal
+from vector_index import similar_books_db
 
 
 
 
+def _format_books(rows) -> str:
+    if not rows:
+        return "No books found for this query."
+    lines = []
+    for r in rows:
+        lines.append(
+            f"- {r['title']} — {r['author']} (ISBN {r['isbn']}), "
+            f"price {r['price']} $, stock {r['stock']}"
+        )
+    return "\n".join(lines)
+
+
 @tool
 def find_books(q: str, by: Literal["title", "author"] = "title") -> str:
     """Search books in the library database by title or author."""
     db = SessionLocal()
     try:
-        rows = find_books_db(db, q=q, by=by)
-        if not rows:
-            return "No books found for this query."
-        lines = []
-        for r in rows:
-            lines.append(
-                f"- {r['title']} — {r['author']} (ISBN {r['isbn']}), "
-                f"price {r['price']} $, stock {r['stock']}"
-            )
-        return "\n".join(lines)
+        return _format_books(find_books_db(db, q=q, by=by))
     finally:
         db.close()
 
 
+async def _afind_books(q: str, by: Literal["title", "author"] = "title") -> str:
+    async with AsyncSessionLocal() as db:
+        return _format_books(await adb.find_books_db(db, q=q, by=by))
+
+find_books.coroutine = _afind_books
+
+
 class OrderItemInput(BaseModel):
     isbn: str = Field(..., description="Book ISBN")
     qty: int = Field(..., gt=0, description="Quantity to order")
@@ -64,6 +83,17 @@ def create_order_tool(customer_id: int, items: List[OrderItemInput]) -> str:
         db.close()
 
 
+async def _acreate_order(customer_id: int, items: List[OrderItemInput]) -> str:
+    # from here on a client disconnect no longer cancels a keyed /chat run
+    mark_written()
+    async with AsyncSessionLocal() as db:
+        items_dicts = [{"isbn": it.isbn, "qty": it.qty} for it in items]
+        order_id = await adb.create_order_db(db, customer_id=customer_id, items=items_dicts)
+        return f"Order {order_id} created successfully for customer {customer_id}."
+
+create_order_tool.coroutine = _acreate_order
+
+
 class RestockInput(BaseModel):
     isbn: str
     qty: int
@@ -80,6 +110,15 @@ def restock_book_tool(isbn: str, qty: int) -> str:
         db.close()
 
 
+async def _arestock_book(isbn: str, qty: int) -> str:
+    mark_written()
+    async with AsyncSessionLocal() as db:
+        new_stock = await adb.restock_book_db(db, isbn=isbn, qty=qty)
+        return f"Book {isbn} restocked by {qty}. New stock = {new_stock}."
+
+restock_book_tool.coroutine = _arestock_book
+
+
 class UpdatePriceInput(BaseModel):
     isbn: str
     price: float
@@ -96,51 +135,144 @@ def update_price_tool(isbn: str, price: float) -> str:
         db.close()
 
 
+async def _aupdate_price(isbn: str, price: float) -> str:
+    mark_written()
+    async with AsyncSessionLocal() as db:
+        new_price = await adb.update_price_db(db, isbn=isbn, price=price)
+        return f"Price of {isbn} updated to {new_price}."
+
+update_price_tool.coroutine = _aupdate_price
+
+
 class OrderStatusInput(BaseModel):
     order_id: int
 
 
+def _format_order_status(data) -> str:
+    order = data["order"]
+    items = data["items"]
+    lines = [
+        f"لThe Status of Order {order['id']}",
+        f"Status: {order['status']}",
+    ]
+    for it in items:
+        pass
+    return "\n".join(lines)
+
+
 @tool("order_status", args_schema=OrderStatusInput)
 def order_status_tool(order_id: int) -> str:
     """Get the full details and status of an order."""
     db = SessionLocal()
     try:
-        data = order_status_db(db, order_id=order_id)
-        order = data["order"]
-        items = data["items"]
-        lines = [
-            f"لThe Status of Order {order['id']}",
-            f"Status: {order['status']}",
-        ]
-        for it in items:
-            pass
-        return "\n".join(lines)
+        return _format_order_status(order_status_db(db, order_id=order_id))
     finally:
         db.close()
 
 
+async def _aorder_status(order_id: int) -> str:
+    async with AsyncSessionLocal() as db:
+        return _format_order_status(await adb.order_status_db(db, order_id=order_id))
+
+order_status_tool.coroutine = _aorder_status
+
+
 class InventorySummaryInput(BaseModel):
     threshold: int = 5
 
 
+def _format_inventory(rows, threshold: int) -> str:
+    if not rows:
+        return f"No books with stock <= {threshold}."
+    lines = [f"Books with stock <= {threshold}:"]
+    for r in rows:
+        lines.append(
+            f"- {r['title']} (ISBN {r['isbn']}), stock {r['stock']}, price {r['price']}"
+        )
+    return "\n".join(lines)
+
+
 @tool("inventory_summary", args_schema=InventorySummaryInput)
 def inventory_summary_tool(threshold: int = 5) -> str:
     """List all books with stock less than or equal to the threshold."""
     db = SessionLocal()
     try:
-        rows = inventory_summary_db(db, threshold=threshold)
+        return _format_inventory(inventory_summary_db(db, threshold=threshold), threshold)
+    finally:
+        db.close()
+
+
+async def _ainventory_summary(threshold: int = 5) -> str:
+    async with AsyncSessionLocal() as db:
+        rows = await adb.inventory_summary_db(db, threshold=threshold)
+        return _format_inventory(rows, threshold)
+
+inventory_summary_tool.coroutine = _ainventory_summary
+
+
+class SimilarBooksInput(BaseModel):
+    q: Optional[str] = Field(None, description="Free-text description of the kind of book wanted")
+    isbn: Optional[str] = Field(None, description="ISBN of a book to find similar ones to")
+    k: int = Field(5, gt=0, description="How many books to return")
+
+
+@tool("similar_books", args_schema=SimilarBooksInput)
+def similar_books_tool(q: Optional[str] = None, isbn: Optional[str] = None, k: int = 5) -> str:
+    """
+    Find books semantically similar to a description or to a given book.
+    Use this when the user asks for "something like <book>".
+    """
+    db = SessionLocal()
+    try:
+        rows = similar_books_db(db, q=q, isbn=isbn, k=k)
         if not rows:
-            return f"No books with stock <= {threshold}."
-        lines = [f"Books with stock <= {threshold}:"]
+            return "No similar books found."
+        lines = []
         for r in rows:
             lines.append(
-                f"- {r['title']} (ISBN {r['isbn']}), stock {r['stock']}, price {r['price']}"
+                f"- {r['title']} — {r['author']} (ISBN {r['isbn']}), "
+                f"price {r['price']} $, stock {r['stock']}, similarity {r['score']}"
             )
         return "\n".join(lines)
     finally:
         db.close()
 
 
+async def _asimilar_books(q: Optional[str] = None, isbn: Optional[str] = None, k: int = 5) -> str:
+    # NumPy-bound; run the sync tool off the event loop
+    return await asyncio.to_thread(similar_books_tool.func, q=q, isbn=isbn, k=k)
+
+similar_books_tool.coroutine = _asimilar_books
+
+
+class StockAcrossBranchesInput(BaseModel):
+    isbn: str
+
+
+def _format_branch_stock(data) -> str:
+    lines = [f"{data['title']} (ISBN {data['isbn']}), total stock {data['total_stock']}:"]
+    for b in data["branches"]:
+        lines.append(f"- branch {b['branch_id']}: stock {b['stock']}, price {b['price']}")
+    for branch_id in sorted(data.get("failed_branches", {})):
+        lines.append(f"- branch {branch_id}: could not be checked")
+    return "\n".join(lines)
+
+
+@tool("stock_across_branches", args_schema=StockAcrossBranchesInput)
+def stock_across_branches_tool(isbn: str) -> str:
+    """
+    Look up the stock of a book in every library branch.
+    Use this when the book is out of stock here or the user asks which branch has it.
+    """
+    return _format_branch_stock(stock_across_branches_db(isbn=isbn))
+
+
+async def _astock_across_branches(isbn: str) -> str:
+    return _format_branch_stock(await adb.stock_across_branches_db(isbn=isbn))
+
+stock_across_branches_tool.coroutine = _astock_across_branches
+
+
 
 
 SYSTEM_PROMPT = """
@@ -153,6 +285,7 @@ ALWAYS use tools whenever the user asks about:
 - updating prices
 - checking order status
 - inventory / low-stock
+- recommending similar books
 
 Never just imagine changes; you MUST call tools to actually update the database.
 Explain briefly to the user what you are doing.
@@ -168,6 +301,8 @@ tools = [
     update_price_tool,
     order_status_tool,
     inventory_summary_tool,
+    similar_books_tool,
+    stock_across_branches_tool,
 ]
 
 
@@ -201,23 +336,58 @@ agent_executor = AgentExecutor(
 )
 
 
-def run_agent(
-    message: str,
-    session_id: Optional[str] = None,
-    db=None,
-) -> str:
-    sid = session_id or "default"
+class _StepBudgetExhausted(Exception):
+    pass
 
-    save_message(sid, "user", message)
 
-    result = agent_executor.invoke(
-        {
-            "input": message,
-            "chat_history": [],   
-        }
-    )
+_WRITE_TOOLS = {"create_order", "restock_book", "update_price"}
+
+
+def _wrote(steps: list) -> bool:
+    return any(getattr(action, "tool", None) in _WRITE_TOOLS for action, _ in steps)
+
 
-    steps = result.get("intermediate_steps", [])
+def _budgets(max_seconds: Optional[float], max_steps: Optional[int]) -> tuple[float, int]:
+    """Per-request budgets, capped by the server-wide limits in config.py."""
+    if max_seconds is not None and max_seconds <= 0:
+        raise ValueError("max_seconds must be positive")
+    if max_steps is not None and max_steps <= 0:
+        raise ValueError("max_steps must be positive")
+    seconds = AGENT_MAX_SECONDS if max_seconds is None else min(max_seconds, AGENT_MAX_SECONDS)
+    steps = AGENT_MAX_STEPS if max_steps is None else min(max_steps, AGENT_MAX_STEPS)
+    return seconds, steps
+
+
+def _collect(chunk, steps: list, started: list, max_steps: int):
+    """
+    Record the tool steps of one streamed executor chunk. A planned action
+    beyond the step budget stops the run before that tool executes.
+    Returns the final output when the chunk carries it.
+    """
+    for _action in chunk.get("actions", []):
+        if started[0] >= max_steps:
+            raise _StepBudgetExhausted
+        started[0] += 1
+    for st in chunk.get("steps", []):
+        steps.append((st.action, st.observation))
+    return chunk.get("output")
+
+
+def _partial_answer(steps: list, reason: str) -> str:
+    if not steps:
+        return (
+            f"I couldn't finish this request ({reason}) before doing anything. "
+            "Please try again or ask for something smaller."
+        )
+    lines = [f"I couldn't finish this request ({reason}). What I did so far:"]
+    for action, observation in steps:
+        name = getattr(action, "tool", "unknown_tool")
+        lines.append(f"- {name}: {observation}")
+    return "\n".join(lines)
+
+
+def _tool_call_records(steps) -> list[tuple]:
+    records = []
     for step in steps:
         try:
             action, observation = step
@@ -233,17 +403,130 @@ def run_agent(
             else:
                 args_data = str(raw_args)
 
-            save_tool_call(
-                sid,
-                name,
-                args_data,
-                {"observation": observation},
-            )
+            records.append((name, args_data, {"observation": observation}))
         except Exception as e:
-            print("Error while saving tool_call:", e)
+            print("Error while reading tool_call:", e)
+    return records
+
+
+def run_agent(
+    message: str,
+    session_id: Optional[str] = None,
+    db=None,
+    max_seconds: Optional[float] = None,
+    max_steps: Optional[int] = None,
+) -> str:
+    sid = session_id or "default"
+    max_seconds, max_steps = _budgets(max_seconds, max_steps)
+    deadline = time.monotonic() + max_seconds
+
+    save_message(sid, "user", message)
 
-    output = result.get("output") or result.get("final_output") or str(result)
+    # the sync path can only check the deadline between steps; the
+    # in-flight LLM call is not interrupted (arun_agent does that)
+    steps, started, output, reason = [], [0], None, None
+    try:
+        for chunk in agent_executor.stream({"input": message, "chat_history": []}):
+            output = _collect(chunk, steps, started, max_steps)
+            if output is not None:
+                break
+            if time.monotonic() > deadline:
+                reason = "deadline_exceeded"
+                break
+    except _StepBudgetExhausted:
+        reason = "step_budget_exhausted"
+    except Exception:
+        # once the database was changed, answer with what was done so an
+        # idempotent caller stores it instead of letting a retry redo it
+        if not _wrote(steps):
+            raise
+        reason = "failed"
+
+    if output is not None:
+        metrics.incr("agent_runs_completed")
+    elif reason == "step_budget_exhausted":
+        metrics.incr("agent_runs_step_budget_exhausted")
+        output = _partial_answer(steps, "step budget exhausted")
+    elif reason == "deadline_exceeded":
+        metrics.incr("agent_runs_deadline_exceeded")
+        output = _partial_answer(steps, "time budget exhausted")
+    elif reason == "failed":
+        metrics.incr("agent_runs_failed")
+        output = _partial_answer(steps, "an error occurred")
+    else:
+        metrics.incr("agent_runs_no_final_answer")
+        output = _partial_answer(steps, "no final answer")
+
+    for name, args_data, observation in _tool_call_records(steps):
+        try:
+            save_tool_call(sid, name, args_data, observation)
+        except Exception as e:
+            print("Error while saving tool_call:", e)
 
     save_message(sid, "assistant", output)
 
     return output
+
+
+async def arun_agent(
+    message: str,
+    session_id: Optional[str] = None,
+    max_seconds: Optional[float] = None,
+    max_steps: Optional[int] = None,
+) -> str:
+    """
+    Async run_agent: LLM calls and tools run on the event loop. When the
+    time budget runs out, or the run is cancelled (client disconnected),
+    the in-flight LLM HTTP call is cancelled with it.
+    """
+    sid = session_id or "default"
+    max_seconds, max_steps = _budgets(max_seconds, max_steps)
+
+    await asave_message(sid, "user", message)
+
+    steps, started = [], [0]
+
+    async def consume():
+        async for chunk in agent_executor.astream({"input": message, "chat_history": []}):
+            output = _collect(chunk, steps, started, max_steps)
+            if output is not None:
+                return output
+        return None
+
+    async def record(output):
+        for name, args_data, observation in _tool_call_records(steps):
+            try:
+                await asave_tool_call(sid, name, args_data, observation)
+            except Exception as e:
+                print("Error while saving tool_call:", e)
+        await asave_message(sid, "assistant", output)
+
+    try:
+        output = await asyncio.wait_for(consume(), timeout=max_seconds)
+        if output is None:
+            metrics.incr("agent_runs_no_final_answer")
+            output = _partial_answer(steps, "no final answer")
+        else:
+            metrics.incr("agent_runs_completed")
+    except asyncio.TimeoutError:
+        metrics.incr("agent_runs_deadline_exceeded")
+        output = _partial_answer(steps, "time budget exhausted")
+    except _StepBudgetExhausted:
+        metrics.incr("agent_runs_step_budget_exhausted")
+        output = _partial_answer(steps, "step budget exhausted")
+    except asyncio.CancelledError:
+        # nobody is waiting for the answer any more; still log the tool
+        # calls that already changed the database
+        metrics.incr("agent_runs_abandoned")
+        await record(_partial_answer(steps, "client disconnected"))
+        raise
+    except Exception:
+        # same as run_agent: after a write, return instead of raising
+        if not _wrote(steps):
+            raise
+        metrics.incr("agent_runs_failed")
+        output = _partial_answer(steps, "an error occurred")
+
+    await record(output)
+
+    return output
@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+# Small closed-loop load generator for the REST endpoints: `concurrency`
+# clients each send their next request as soon as the previous one returns.
+# Run it against two servers (e.g. the sync and the async build on
+# different ports) with the same settings and compare requests/s and p99.
+#
+#   pip install httpx
+#   python bench.py --url http://127.0.0.1:8001 --concurrency 64 --requests 5000
+
+
+async def _client(http, paths, counter, total, latencies, errors):
+    while True:
+        n = counter[0]
+        if n >= total:
+            return
+        counter[0] += 1
+        path = paths[n % len(paths)]
+        start = time.perf_counter()
+        try:
+            resp = await http.get(path)
+            if resp.status_code != 200:
+                errors.append(resp.status_code)
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(url: str, paths: list[str], concurrency: int, total: int, warmup: int) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as http:
+        for i in range(warmup):
+            await http.get(paths[i % len(paths)])
+
+        latencies, errors, counter = [], [], [0]
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            _client(http, paths, counter, total, latencies, errors)
+            for _ in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": round(elapsed, 2),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(pct(50), 1),
+        "p99_ms": round(pct(99), 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the library REST API.")
+    parser.add_argument("--url", default="http://127.0.0.1:8001")
+    parser.add_argument("--path", action="append",
+                        help="path to request, repeatable (default: /search_books and /inventory_summary)")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=200)
+    opts = parser.parse_args()
+
+    paths = opts.path or ["/search_books?q=Clean", "/inventory_summary?threshold=5"]
+    result = asyncio.run(run(opts.url, paths, opts.concurrency, opts.requests, opts.warmup))
+    print(" ".join(f"{k}={v}" for k, v in result.items()))
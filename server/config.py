@@ -1,4 +1,5 @@
 import os
+import json
 from dotenv import load_dotenv
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__)) 
@@ -10,3 +11,59 @@ DB_PATH = os.path.join(BASE_DIR, "library.db")
 DB_PATH = DB_PATH.replace("\\", "/")
 
 DATABASE_URL = f"sqlite:///{DB_PATH}"
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
+
+# Every branch gets its own SQLite file. DEFAULT_BRANCH lives in library.db,
+# other branches in BRANCHES_DIR/<branch_id>.db unless SHARD_MAP overrides
+# them, e.g. SHARD_MAP='{"north": "/data/north.db"}'.
+DEFAULT_BRANCH = os.getenv("DEFAULT_BRANCH", "main")
+BRANCHES_DIR = os.path.join(BASE_DIR, "branches").replace("\\", "/")
+SHARD_MAP = json.loads(os.getenv("SHARD_MAP", "{}"))
+SHARD_IDLE_TIMEOUT = float(os.getenv("SHARD_IDLE_TIMEOUT", "300"))
+SCHEMA_PATH = os.path.join(BASE_DIR, "db", "schema.sql")
+
+VECTOR_INDEX_PATH = os.path.join(BASE_DIR, "library.vectors").replace("\\", "/")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "256"))
+EMBEDDER = os.getenv("EMBEDDER", "")
+VECTOR_SYNC_INTERVAL = float(os.getenv("VECTOR_SYNC_INTERVAL", "30"))
+IVF_MIN_ROWS = int(os.getenv("IVF_MIN_ROWS", "20000"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+# how long an unfinished request owns its key; after that a retry may take
+# the key over (the worker that held it is assumed dead)
+IDEMPOTENCY_LEASE = int(os.getenv("IDEMPOTENCY_LEASE", "120"))
+
+# Shared secret for the admin endpoints (X-Admin-Token: /export,
+# /debug/profiles) and for X-Profile. Empty disables them. Falls back to
+# the old PROFILE_ADMIN_TOKEN name.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or os.getenv("PROFILE_ADMIN_TOKEN", "")
+
+# On-demand request profiling. A request is profiled when it carries
+# X-Profile: <ADMIN_TOKEN>, or at random 1 in PROFILE_SAMPLE_N
+# requests (0 = off). Only paths in PROFILE_PATHS are considered.
+PROFILE_SAMPLE_N = int(os.getenv("PROFILE_SAMPLE_N", "0"))
+PROFILE_PATHS = [p for p in os.getenv("PROFILE_PATHS", "/chat,/create_order").split(",") if p]
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_DIR = os.path.join(BASE_DIR, "profiles").replace("\\", "/")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+
+# Agent run budgets. Requests may ask for less, never for more. The time
+# budget stays under the Streamlit client's 60 s timeout so users get a
+# (partial) answer instead of a timeout.
+AGENT_MAX_SECONDS = float(os.getenv("AGENT_MAX_SECONDS", "50"))
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", "8"))
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+# Once a key's lease runs out, a retry on another worker takes the key over
+# and runs the agent again. The lease must therefore outlast the longest run
+# plus the time needed to store its reply, or one chat could create an order twice.
+IDEMPOTENCY_LEASE_MARGIN = 30
+if IDEMPOTENCY_LEASE < AGENT_MAX_SECONDS + IDEMPOTENCY_LEASE_MARGIN:
+    raise ValueError(
+        f"IDEMPOTENCY_LEASE ({IDEMPOTENCY_LEASE}s) must be at least "
+        f"AGENT_MAX_SECONDS ({AGENT_MAX_SECONDS:g}s) + {IDEMPOTENCY_LEASE_MARGIN}s"
+    )
+
+EXPORT_DIR = os.path.join(BASE_DIR, "exports").replace("\\", "/")
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
@@ -1,13 +1,18 @@
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, Session
-from config import DATABASE_URL
+from concurrent.futures import ThreadPoolExecutor
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from config import DEFAULT_BRANCH
+from shards import router, current_branch
+import metrics
+
+engine = router.engine(DEFAULT_BRANCH)
+
+
+def SessionLocal() -> Session:
+    """Open a session on the shard of the branch this request is routed to."""
+    return router.session(current_branch.get())
 
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 
 def get_db():
     db = SessionLocal()
@@ -23,6 +28,11 @@ def find_books_db(db: Session, q: str, by: str = "title"):
     return db.execute(sql, {"q": f"%{q}%"}).mappings().all()
 
 
+def list_books_db(db: Session):
+    rows = db.execute(text("SELECT isbn, title, author, price, stock FROM books")).mappings().all()
+    return [dict(r) for r in rows]
+
+
 def create_order_db(db: Session, customer_id: int, items: list[dict]):
     """
     items: [{'isbn': '9780132350884', 'qty': 3}, ...]
@@ -157,3 +167,62 @@ def inventory_summary_db(db: Session, threshold: int = 5):
     ).mappings().all()
 
     return [dict(r) for r in rows]
+
+
+def _fan_out(fn):
+    """
+    Run fn(db) on every branch in parallel. Returns ({branch_id: result},
+    {branch_id: error}); one broken shard doesn't fail the others.
+    """
+    branches = router.branches()
+
+    def run(branch_id):
+        try:
+            db = router.session(branch_id)
+            try:
+                return branch_id, fn(db), None
+            finally:
+                db.close()
+        except Exception as e:
+            print(f"Branch {branch_id} failed:", e)
+            metrics.incr("branch_fan_out_errors")
+            return branch_id, None, str(e).partition("\n")[0] or type(e).__name__
+
+    with ThreadPoolExecutor(max_workers=min(8, len(branches))) as pool:
+        outcomes = list(pool.map(run, branches))
+    results = {b: r for b, r, err in outcomes if err is None}
+    failed = {b: err for b, _, err in outcomes if err is not None}
+    return results, failed
+
+
+def find_books_all_branches_db(q: str, by: str = "title"):
+    results, failed = _fan_out(lambda db: find_books_db(db, q=q, by=by))
+    rows = []
+    for branch_id, branch_rows in results.items():
+        rows.extend({**dict(r), "branch_id": branch_id} for r in branch_rows)
+    return {"books": rows, "failed_branches": failed}
+
+
+def stock_across_branches_db(isbn: str):
+    def lookup(db):
+        return db.execute(
+            text("SELECT isbn, title, price, stock FROM books WHERE isbn = :isbn"),
+            {"isbn": isbn}
+        ).mappings().first()
+
+    results, failed = _fan_out(lookup)
+    branches = [
+        {"branch_id": b, "price": r["price"], "stock": r["stock"]}
+        for b, r in results.items() if r
+    ]
+    if not branches:
+        unreachable = f" (unreachable: {', '.join(sorted(failed))})" if failed else ""
+        raise ValueError(f"Book {isbn} not found in any branch{unreachable}")
+    title = next(r["title"] for r in results.values() if r)
+    return {
+        "isbn": isbn,
+        "title": title,
+        "total_stock": sum(b["stock"] for b in branches),
+        "branches": branches,
+        "failed_branches": failed,
+    }
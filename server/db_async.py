@@ -0,0 +1,238 @@
+"""
+AsyncSession (sqlite+aiosqlite) variants of the helpers in db.py, used by
+the async agent tools and the idempotent write endpoints. db.py stays the
+sync API for the read endpoints, scripts and the sync agent path.
+"""
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from shards import router, current_branch
+import metrics
+
+
+def AsyncSessionLocal() -> AsyncSession:
+    """Open an async session on the shard of the branch this request is routed to."""
+    return router.async_session(current_branch.get())
+
+
+async def get_async_db():
+    db = AsyncSessionLocal()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def find_books_db(db: AsyncSession, q: str, by: str = "title"):
+    column = "author" if by == "author" else "title"
+    sql = text(f"SELECT isbn, title, author, price, stock FROM books WHERE {column} LIKE :q")
+    res = await db.execute(sql, {"q": f"%{q}%"})
+    return res.mappings().all()
+
+
+async def create_order_db(db: AsyncSession, customer_id: int, items: list[dict]):
+    """
+    items: [{'isbn': '9780132350884', 'qty': 3}, ...]
+    """
+    res = await db.execute(
+        text("SELECT id FROM customers WHERE id = :cid"),
+        {"cid": customer_id}
+    )
+    if not res.mappings().first():
+        raise ValueError(f"Customer {customer_id} not found")
+
+    for item in items:
+        isbn = item["isbn"]
+        qty = int(item["qty"])
+        res = await db.execute(
+            text("SELECT isbn, stock FROM books WHERE isbn = :isbn"),
+            {"isbn": isbn}
+        )
+        book = res.mappings().first()
+        if not book:
+            raise ValueError(f"Book {isbn} not found")
+        if book["stock"] < qty:
+            raise ValueError(f"Not enough stock for {isbn}, have {book['stock']}, need {qty}")
+
+    try:
+        res = await db.execute(
+            text("INSERT INTO orders (customer_id, status) VALUES (:cid, :status)"),
+            {"cid": customer_id, "status": "completed"}
+        )
+        order_id = res.lastrowid
+
+        for item in items:
+            isbn = item["isbn"]
+            qty = int(item["qty"])
+
+            res = await db.execute(
+                text("SELECT price, stock FROM books WHERE isbn = :isbn"),
+                {"isbn": isbn}
+            )
+            book = res.mappings().first()
+
+            await db.execute(
+                text("""
+                    INSERT INTO order_items (order_id, isbn, qty, price_at_order)
+                    VALUES (:oid, :isbn, :qty, :price)
+                """),
+                {"oid": order_id, "isbn": isbn, "qty": qty, "price": book["price"]}
+            )
+
+            await db.execute(
+                text("UPDATE books SET stock = stock - :qty WHERE isbn = :isbn"),
+                {"qty": qty, "isbn": isbn}
+            )
+
+        await db.commit()
+        return order_id
+
+    except Exception:
+        await db.rollback()
+        raise
+
+
+async def restock_book_db(db: AsyncSession, isbn: str, qty: int):
+    res = await db.execute(
+        text("SELECT isbn, stock FROM books WHERE isbn = :isbn"),
+        {"isbn": isbn}
+    )
+    book = res.mappings().first()
+    if not book:
+        raise ValueError(f"Book {isbn} not found")
+
+    new_stock = book["stock"] + qty
+    await db.execute(
+        text("UPDATE books SET stock = stock + :qty WHERE isbn = :isbn"),
+        {"qty": qty, "isbn": isbn}
+    )
+    await db.commit()
+    return new_stock
+
+
+async def update_price_db(db: AsyncSession, isbn: str, price: float):
+    res = await db.execute(
+        text("SELECT isbn FROM books WHERE isbn = :isbn"),
+        {"isbn": isbn}
+    )
+    if not res.mappings().first():
+        raise ValueError(f"Book {isbn} not found")
+
+    await db.execute(
+        text("UPDATE books SET price = :price WHERE isbn = :isbn"),
+        {"price": price, "isbn": isbn}
+    )
+    await db.commit()
+    return price
+
+
+async def order_status_db(db: AsyncSession, order_id: int):
+    res = await db.execute(
+        text("""
+            SELECT o.id, o.customer_id, o.status, o.created_at,
+                   c.name AS customer_name, c.email AS customer_email
+            FROM orders o
+            JOIN customers c ON o.customer_id = c.id
+            WHERE o.id = :oid
+        """),
+        {"oid": order_id}
+    )
+    order = res.mappings().first()
+
+    if not order:
+        raise ValueError(f"Order {order_id} not found")
+
+    res = await db.execute(
+        text("""
+            SELECT oi.isbn, b.title, oi.qty, oi.price_at_order
+            FROM order_items oi
+            JOIN books b ON oi.isbn = b.isbn
+            WHERE oi.order_id = :oid
+        """),
+        {"oid": order_id}
+    )
+    items = res.mappings().all()
+
+    return {
+        "order": dict(order),
+        "items": [dict(i) for i in items],
+    }
+
+
+async def inventory_summary_db(db: AsyncSession, threshold: int = 5):
+    res = await db.execute(
+        text("""
+            SELECT isbn, title, author, price, stock
+            FROM books
+            WHERE stock <= :th
+            ORDER BY stock ASC
+        """),
+        {"th": threshold}
+    )
+    return [dict(r) for r in res.mappings().all()]
+
+
+async def _fan_out(fn):
+    """
+    Await fn(db) on every branch concurrently. Returns ({branch_id: result},
+    {branch_id: error}); one broken shard doesn't fail the others.
+    """
+    branches = router.branches()
+
+    async def run(branch_id):
+        try:
+            db = router.async_session(branch_id)
+            try:
+                return await fn(db)
+            finally:
+                await db.close()
+        except Exception as e:
+            print(f"Branch {branch_id} failed:", e)
+            metrics.incr("branch_fan_out_errors")
+            raise
+
+    outcomes = await asyncio.gather(*(run(b) for b in branches), return_exceptions=True)
+    results, failed = {}, {}
+    for branch_id, outcome in zip(branches, outcomes):
+        if isinstance(outcome, Exception):
+            failed[branch_id] = str(outcome).partition("\n")[0] or type(outcome).__name__
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        else:
+            results[branch_id] = outcome
+    return results, failed
+
+
+async def find_books_all_branches_db(q: str, by: str = "title"):
+    results, failed = await _fan_out(lambda db: find_books_db(db, q=q, by=by))
+    rows = []
+    for branch_id, branch_rows in results.items():
+        rows.extend({**dict(r), "branch_id": branch_id} for r in branch_rows)
+    return {"books": rows, "failed_branches": failed}
+
+
+async def stock_across_branches_db(isbn: str):
+    async def lookup(db):
+        res = await db.execute(
+            text("SELECT isbn, title, price, stock FROM books WHERE isbn = :isbn"),
+            {"isbn": isbn}
+        )
+        return res.mappings().first()
+
+    results, failed = await _fan_out(lookup)
+    branches = [
+        {"branch_id": b, "price": r["price"], "stock": r["stock"]}
+        for b, r in results.items() if r
+    ]
+    if not branches:
+        unreachable = f" (unreachable: {', '.join(sorted(failed))})" if failed else ""
+        raise ValueError(f"Book {isbn} not found in any branch{unreachable}")
+    title = next(r["title"] for r in results.values() if r)
+    return {
+        "isbn": isbn,
+        "title": title,
+        "total_stock": sum(b["stock"] for b in branches),
+        "branches": branches,
+        "failed_branches": failed,
+    }
@@ -1,5 +1,6 @@
 from sqlalchemy import text
 from db import SessionLocal
+from db_async import AsyncSessionLocal
 import json
 
 
@@ -44,3 +45,42 @@ def save_tool_call(session_id: str, name: str, args: dict, result: dict) -> None
         db.close()
 
 
+async def asave_message(session_id: str, role: str, content: str) -> None:
+
+    db = AsyncSessionLocal()
+    try:
+        await db.execute(
+            text("""
+                INSERT INTO messages (session_id, role, content)
+                VALUES (:sid, :role, :content)
+            """),
+            {
+                "sid": session_id,
+                "role": role,
+                "content": content,
+            },
+        )
+        await db.commit()
+    finally:
+        await db.close()
+
+
+async def asave_tool_call(session_id: str, name: str, args: dict, result: dict) -> None:
+
+    db = AsyncSessionLocal()
+    try:
+        await db.execute(
+            text("""
+                INSERT INTO tool_calls (session_id, name, args_json, result_json)
+                VALUES (:sid, :name, :args, :result)
+            """),
+            {
+                "sid": session_id,
+                "name": name,
+                "args": json.dumps(args, ensure_ascii=False),
+                "result": json.dumps(result, ensure_ascii=False),
+            },
+        )
+        await db.commit()
+    finally:
+        await db.close()
@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import threading
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+from config import EXPORT_DIR, EXPORT_CHUNK_SIZE
+from shards import router
+
+
+# Incremental export of analytics tables to Parquet, so ad-hoc queries run
+# off-box instead of holding read transactions on the live database.
+#
+# Layout: <EXPORT_DIR>/<table>/branch=<id>/date=<YYYY-MM-DD>/part-<first>-<last>.parquet
+# Rows are exported once, by increasing id (orders.id for order_items,
+# tool_calls.id for tool_calls); later updates to an exported row, such as
+# an order status change, are not picked up.
+
+ORDER_ITEMS_SCHEMA = pa.schema([
+    ("order_id", pa.int64()),
+    ("isbn", pa.string()),
+    ("qty", pa.int64()),
+    ("price_at_order", pa.float64()),
+    ("line_total", pa.float64()),
+    ("title", pa.string()),
+    ("author", pa.string()),
+    ("customer_id", pa.int64()),
+    ("status", pa.string()),
+    ("created_at", pa.timestamp("s")),
+    ("branch_id", pa.string()),
+])
+
+TOOL_CALLS_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("session_id", pa.string()),
+    ("name", pa.string()),
+    ("args", pa.map_(pa.string(), pa.string())),
+    ("arg_isbn", pa.string()),
+    ("arg_qty", pa.int64()),
+    ("arg_price", pa.float64()),
+    ("arg_customer_id", pa.int64()),
+    ("arg_order_id", pa.int64()),
+    ("args_json", pa.string()),
+    ("result_json", pa.string()),
+    ("created_at", pa.timestamp("s")),
+    ("branch_id", pa.string()),
+])
+
+_ORDER_ITEMS_SQL = text("""
+    SELECT oi.order_id, oi.isbn, oi.qty, oi.price_at_order,
+           b.title, b.author, o.customer_id, o.status, o.created_at
+    FROM order_items oi
+    JOIN orders o ON o.id = oi.order_id
+    LEFT JOIN books b ON b.isbn = oi.isbn
+    WHERE oi.order_id > :wm AND oi.order_id <= :hi
+    ORDER BY oi.order_id
+""")
+
+_TOOL_CALLS_SQL = text("""
+    SELECT id, session_id, name, args_json, result_json, created_at
+    FROM tool_calls
+    WHERE id > :wm
+    ORDER BY id
+    LIMIT :lim
+""")
+
+_export_lock = threading.Lock()
+
+
+def _parse_ts(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _watermark_path() -> str:
+    return os.path.join(EXPORT_DIR, "_watermarks.json")
+
+
+def load_watermarks() -> dict:
+    try:
+        with open(_watermark_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_watermarks(marks: dict):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    tmp = _watermark_path() + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(marks, f, indent=2, sort_keys=True)
+    os.replace(tmp, _watermark_path())
+
+
+class _PartitionWriter:
+    """
+    One ParquetWriter per date partition for the current run. Each chunk is
+    written as its own row group, so memory stays bounded by the chunk size.
+    Files are written under a .tmp name and renamed on close, named after
+    the id range they hold, so re-running after a crash overwrites them.
+    """
+
+    def __init__(self, table: str, branch_id: str, schema: pa.Schema):
+        self.base = os.path.join(EXPORT_DIR, table, f"branch={branch_id}")
+        self.schema = schema
+        self.writers = {}
+
+    def write(self, date: str, batch: pa.RecordBatch, first_id: int, last_id: int):
+        entry = self.writers.get(date)
+        if entry is None:
+            folder = os.path.join(self.base, f"date={date}")
+            os.makedirs(folder, exist_ok=True)
+            tmp = os.path.join(folder, f".part-{first_id}.parquet.tmp")
+            writer = pq.ParquetWriter(tmp, self.schema)
+            entry = self.writers[date] = [writer, folder, tmp, first_id, last_id]
+        entry[0].write_batch(batch)
+        entry[4] = last_id
+
+    def close(self) -> list[str]:
+        files = []
+        for writer, folder, tmp, first_id, last_id in self.writers.values():
+            writer.close()
+            # a run that crashed before saving its watermark may have left
+            # a shorter file for the same starting id
+            for stale in os.listdir(folder):
+                if stale.startswith(f"part-{first_id}-"):
+                    os.remove(os.path.join(folder, stale))
+            final = os.path.join(folder, f"part-{first_id}-{last_id}.parquet")
+            os.replace(tmp, final)
+            files.append(final)
+        self.writers = {}
+        return files
+
+
+def _write_by_date(out: _PartitionWriter, rows: list[dict], schema: pa.Schema, id_col: str):
+    by_date = {}
+    for r in rows:
+        date = r["created_at"].date().isoformat() if r["created_at"] else "unknown"
+        by_date.setdefault(date, []).append(r)
+    for date, part in by_date.items():
+        batch = pa.RecordBatch.from_pylist(part, schema=schema)
+        out.write(date, batch, part[0][id_col], part[-1][id_col])
+
+
+def export_order_items(branch_id: str, watermark: int, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Export order_items (joined with orders and books) for orders with
+    id > watermark. Returns (new_watermark, rows, files).
+    """
+    out = _PartitionWriter("order_items", branch_id, ORDER_ITEMS_SCHEMA)
+    total = 0
+    db = router.session(branch_id)
+    try:
+        while True:
+            # page on orders.id so an order's items never straddle two chunks
+            hi = db.execute(
+                text("""
+                    SELECT MAX(id) FROM (
+                        SELECT id FROM orders WHERE id > :wm ORDER BY id LIMIT :lim
+                    )
+                """),
+                {"wm": watermark, "lim": chunk_size}
+            ).scalar()
+            if hi is None:
+                break
+            rows = db.execute(_ORDER_ITEMS_SQL, {"wm": watermark, "hi": hi}).mappings().all()
+            # end the read transaction between chunks so writers aren't held up
+            db.rollback()
+
+            batch_rows = []
+            for r in rows:
+                batch_rows.append({
+                    "order_id": r["order_id"],
+                    "isbn": r["isbn"],
+                    "qty": r["qty"],
+                    "price_at_order": r["price_at_order"],
+                    "line_total": r["qty"] * r["price_at_order"],
+                    "title": r["title"],
+                    "author": r["author"],
+                    "customer_id": r["customer_id"],
+                    "status": r["status"],
+                    "created_at": _parse_ts(r["created_at"]),
+                    "branch_id": branch_id,
+                })
+            _write_by_date(out, batch_rows, ORDER_ITEMS_SCHEMA, "order_id")
+            total += len(batch_rows)
+            watermark = hi
+        return watermark, total, out.close()
+    finally:
+        db.close()
+
+
+def _parse_args(args_json: str) -> dict:
+    try:
+        args = json.loads(args_json)
+    except (TypeError, ValueError):
+        return {}
+    if not isinstance(args, dict):
+        return {"input": args if isinstance(args, str) else json.dumps(args, ensure_ascii=False)}
+    return args
+
+
+def export_tool_calls(branch_id: str, watermark: int, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Export tool_calls with id > watermark, with args_json parsed into a
+    map column plus typed columns for the common arguments.
+    Returns (new_watermark, rows, files).
+    """
+    out = _PartitionWriter("tool_calls", branch_id, TOOL_CALLS_SCHEMA)
+    total = 0
+    db = router.session(branch_id)
+    try:
+        while True:
+            rows = db.execute(_TOOL_CALLS_SQL, {"wm": watermark, "lim": chunk_size}).mappings().all()
+            db.rollback()
+            if not rows:
+                break
+
+            batch_rows = []
+            for r in rows:
+                args = _parse_args(r["args_json"])
+                batch_rows.append({
+                    "id": r["id"],
+                    "session_id": r["session_id"],
+                    "name": r["name"],
+                    "args": [
+                        (str(k), v if isinstance(v, str) else json.dumps(v, ensure_ascii=False))
+                        for k, v in args.items()
+                    ],
+                    "arg_isbn": args.get("isbn") if isinstance(args.get("isbn"), str) else None,
+                    "arg_qty": _as_int(args.get("qty")),
+                    "arg_price": _as_float(args.get("price")),
+                    "arg_customer_id": _as_int(args.get("customer_id")),
+                    "arg_order_id": _as_int(args.get("order_id")),
+                    "args_json": r["args_json"],
+                    "result_json": r["result_json"],
+                    "created_at": _parse_ts(r["created_at"]),
+                    "branch_id": branch_id,
+                })
+            _write_by_date(out, batch_rows, TOOL_CALLS_SCHEMA, "id")
+            total += len(batch_rows)
+            watermark = rows[-1]["id"]
+        return watermark, total, out.close()
+    finally:
+        db.close()
+
+
+_EXPORTERS = {
+    "order_items": export_order_items,
+    "tool_calls": export_tool_calls,
+}
+
+
+def run_export(branches: list[str] | None = None, tables: list[str] | None = None,
+               chunk_size: int = EXPORT_CHUNK_SIZE) -> dict:
+    """
+    Export everything new since the last run. The watermark of a
+    (branch, table) pair only advances after its files are in place.
+    """
+    if not _export_lock.acquire(blocking=False):
+        raise ValueError("An export is already running")
+    try:
+        branches = branches or router.branches()
+        tables = tables or list(_EXPORTERS)
+        for t in tables:
+            if t not in _EXPORTERS:
+                raise ValueError(f"Unknown table {t}")
+
+        marks = load_watermarks()
+        summary = []
+        for branch_id in branches:
+            for table in tables:
+                key = f"{branch_id}/{table}"
+                start = marks.get(key, 0)
+                new_mark, rows, files = _EXPORTERS[table](branch_id, start, chunk_size)
+                if new_mark != start:
+                    marks[key] = new_mark
+                    _save_watermarks(marks)
+                summary.append({
+                    "branch_id": branch_id,
+                    "table": table,
+                    "from": start,
+                    "to": new_mark,
+                    "rows": rows,
+                    "files": [os.path.relpath(f, EXPORT_DIR) for f in files],
+                })
+        return {"export_dir": EXPORT_DIR, "exports": summary}
+    finally:
+        _export_lock.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export new orders and tool calls to Parquet.")
+    parser.add_argument("--branch", action="append", help="branch id (repeatable, default: all)")
+    parser.add_argument("--table", action="append", choices=list(_EXPORTERS),
+                        help="table to export (repeatable, default: all)")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    opts = parser.parse_args()
+
+    result = run_export(opts.branch, opts.table, opts.chunk_size)
+    for e in result["exports"]:
+        print(f"[{e['branch_id']}] {e['table']}: {e['rows']} rows, "
+              f"watermark {e['from']} -> {e['to']}, {len(e['files'])} files")
@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import json
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from config import IDEMPOTENCY_TTL, IDEMPOTENCY_LEASE
+from db_async import AsyncSessionLocal
+from shards import current_branch
+
+
+class AsyncSingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs
+    `fn`, everyone arriving while it is in flight waits and gets the same
+    result (or exception). Nothing is cached once the call finishes.
+
+    The shared run is its own task on the event loop; a caller that is
+    cancelled (e.g. its client went away) only stops waiting, and the run
+    is cancelled once no caller is left, unless `detach(key)` returns True,
+    in which case it runs to completion.
+    """
+
+    def __init__(self, detach=None):
+        self._calls: dict = {}
+        self._detach = detach or (lambda key: False)
+
+    async def do(self, key, fn):
+        entry = self._calls.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(fn())
+            entry = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _t: self._calls.pop(key, None))
+        task = entry[0]
+
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not task.done() and not self._detach(key):
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+
+# runs (by flight key) that have started changing the database
+_writing = set()
+_current_run: ContextVar = ContextVar("idempotent_run", default=None)
+
+# a keyed run that has started writing finishes even if every caller left,
+# so its response is stored and the client's retry replays it instead of
+# writing again; before that it is cancelled and its key released
+_async_flight = AsyncSingleFlight(detach=lambda key: key in _writing)
+_ready_branches = set()
+
+_CREATE_SQL = text("""
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+      endpoint TEXT NOT NULL,
+      key TEXT NOT NULL,
+      request_hash TEXT NOT NULL,
+      response_json TEXT,
+      created_at REAL NOT NULL,
+      expires_at REAL NOT NULL,
+      PRIMARY KEY (endpoint, key)
+    )
+""")
+_SELECT_SQL = text("""
+    SELECT request_hash, response_json, created_at FROM idempotency_keys
+    WHERE endpoint = :ep AND key = :key AND expires_at > :now
+""")
+_PURGE_SQL = text("DELETE FROM idempotency_keys WHERE expires_at <= :now")
+_INSERT_SQL = text("""
+    INSERT INTO idempotency_keys (endpoint, key, request_hash, created_at, expires_at)
+    VALUES (:ep, :key, :hash, :now, :exp)
+""")
+_TAKEOVER_SQL = text("""
+    UPDATE idempotency_keys SET created_at = :now, expires_at = :exp
+    WHERE endpoint = :ep AND key = :key AND response_json IS NULL AND created_at = :old
+""")
+# created_at doubles as the lease token: only the current owner may
+# store a response or release the key
+_DELETE_SQL = text("""
+    DELETE FROM idempotency_keys
+    WHERE endpoint = :ep AND key = :key AND created_at = :token
+""")
+_STORE_SQL = text("""
+    UPDATE idempotency_keys SET response_json = :resp
+    WHERE endpoint = :ep AND key = :key AND created_at = :token
+""")
+
+
+class IdempotencyConflict(Exception):
+    """The key can't be used for this request right now (409) or at all (422)."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def mark_written():
+    """
+    Call right before an idempotent run changes the database. From then on
+    the run is finished even if its client disconnects. No-op outside
+    run_idempotent_async.
+    """
+    flight_key = _current_run.get()
+    if flight_key is not None:
+        _writing.add(flight_key)
+
+
+def _mismatch():
+    return IdempotencyConflict(422, "Idempotency-Key was already used with a different request")
+
+
+def _in_progress():
+    return IdempotencyConflict(409, "A request with this Idempotency-Key is still in progress")
+
+
+def _request_hash(payload) -> str:
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _check(row, request_hash: str, now: float):
+    """
+    Decide what to do with an existing key. Returns the stored response to
+    replay, or None when the previous owner's lease ran out and the key may
+    be taken over.
+    """
+    if row["request_hash"] != request_hash:
+        raise _mismatch()
+    if row["response_json"] is not None:
+        return json.loads(row["response_json"])
+    if now - row["created_at"] < IDEMPOTENCY_LEASE:
+        raise _in_progress()
+    return None
+
+
+async def _areserve(endpoint: str, key: str, request_hash: str):
+    """
+    Returns (stored_response, None) to replay, or (None, token) if this
+    caller now owns the key and must execute the request.
+    """
+    now = time.time()
+    params = {"ep": endpoint, "key": key, "hash": request_hash,
+              "now": now, "exp": now + IDEMPOTENCY_TTL}
+    db = AsyncSessionLocal()
+    try:
+        if current_branch.get() not in _ready_branches:
+            await db.execute(_CREATE_SQL)
+            await db.commit()
+            _ready_branches.add(current_branch.get())
+
+        res = await db.execute(_SELECT_SQL, params)
+        row = res.mappings().first()
+        if row:
+            stored = _check(row, request_hash, now)
+            if stored is not None:
+                return stored, None
+            res = await db.execute(_TAKEOVER_SQL, {**params, "old": row["created_at"]})
+            await db.commit()
+            if res.rowcount != 1:
+                raise _in_progress()
+            return None, now
+
+        await db.execute(_PURGE_SQL, params)
+        try:
+            await db.execute(_INSERT_SQL, params)
+            await db.commit()
+        except IntegrityError:
+            # another worker process reserved it between our SELECT and INSERT
+            await db.rollback()
+            raise _in_progress()
+        return None, now
+    finally:
+        await db.close()
+
+
+async def _afinish(endpoint: str, key: str, token: float, response):
+    params = {"ep": endpoint, "key": key, "token": token}
+    db = AsyncSessionLocal()
+    try:
+        if response is None:
+            await db.execute(_DELETE_SQL, params)
+        else:
+            await db.execute(_STORE_SQL, {**params,
+                                          "resp": json.dumps(response, ensure_ascii=False, default=str)})
+        await db.commit()
+    finally:
+        await db.close()
+
+
+async def _arun_once(flight_key, endpoint: str, key: str, payload, fn):
+    stored, token = await _areserve(endpoint, key, _request_hash(payload))
+    if stored is not None:
+        return stored
+    # seen by fn and every task it starts (they copy this task's context)
+    _current_run.set(flight_key)
+    try:
+        try:
+            response = await fn()
+        except BaseException:
+            # nothing was stored, so a retry may execute. `fn` must return a
+            # response rather than raise once it has made changes, and after
+            # mark_written() it is only cancelled when the server shuts down
+            await _afinish(endpoint, key, token, None)
+            raise
+        await _afinish(endpoint, key, token, response)
+        return response
+    finally:
+        _writing.discard(flight_key)
+
+
+async def run_idempotent_async(endpoint: str, key: str | None, payload, fn):
+    """
+    Await `fn()` at most once per (endpoint, Idempotency-Key) within
+    IDEMPOTENCY_TTL seconds; retries replay the stored JSON response.
+    Without a key, `fn` simply runs. Raises IdempotencyConflict when the
+    key belongs to a different request or one still in progress.
+
+    When the caller is cancelled, a run that hasn't called mark_written()
+    yet is cancelled and its key released; one that has goes on, and its
+    response is stored for the retry.
+    """
+    if not key:
+        return await fn()
+    flight_key = (current_branch.get(), endpoint, key)
+    return await _async_flight.do(
+        flight_key,
+        lambda: _arun_once(flight_key, endpoint, key, payload, fn),
+    )
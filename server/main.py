@@ -1,21 +1,44 @@
-from fastapi import FastAPI, Depends, Query
-from pydantic import BaseModel
+from fastapi import FastAPI, Depends, Query, Header, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+from pydantic import BaseModel, Field
 from sqlalchemy.orm import Session
-from sqlalchemy import text
-from agent import run_agent
+from agent import arun_agent
 from dotenv import load_dotenv
 from typing import Optional  
+import asyncio
+import time
 load_dotenv()
 
 from db import (
     get_db,
+    list_books_db,
     find_books_db,
+    order_status_db,
+    inventory_summary_db,
+    find_books_all_branches_db,
+    stock_across_branches_db,
+)
+from db_async import (
+    AsyncSessionLocal,
     create_order_db,
     restock_book_db,
     update_price_db,
-    order_status_db,
-    inventory_summary_db,
 )
+from shards import router, current_branch
+from vector_index import similar_books_db
+from config import PROFILE_PATHS, DISCONNECT_POLL_INTERVAL
+import metrics
+from profiling import (
+    is_admin_token,
+    should_profile,
+    start_profiler,
+    finish_profiler,
+    list_profiles,
+    profile_path,
+)
+from export import run_export
+from idempotency import AsyncSingleFlight, IdempotencyConflict, mark_written, run_idempotent_async
 
 
 class OrderItem(BaseModel):
@@ -39,19 +62,197 @@ class UpdatePriceRequest(BaseModel):
 class ChatRequest(BaseModel):
     message: str
     session_id: str | None = None
+    max_seconds: float | None = Field(None, gt=0)
+    max_steps: int | None = Field(None, gt=0)
 
 
 
 
-app = FastAPI()
+async def route_branch(
+    branch_id: Optional[str] = Header(None, alias="X-Branch-Id"),
+) -> str:
+    """
+    Route the request to its branch shard. This is async on purpose: the
+    context variable is set on the request task, so async endpoints see it
+    directly and sync ones (run in the thread pool with a copy) as well.
+    """
+    branch_id = branch_id or current_branch.get()
+    try:
+        if not router.exists(branch_id):
+            raise HTTPException(status_code=404, detail=f"Branch {branch_id} not found")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    current_branch.set(branch_id)
+    return branch_id
+
+
+app = FastAPI(dependencies=[Depends(route_branch)])
+
+# identical (branch, session_id, message) chats in flight share one agent run
+_chat_flight = AsyncSingleFlight()
+
+
+@app.exception_handler(IdempotencyConflict)
+async def idempotency_conflict(request: Request, exc: IdempotencyConflict):
+    return JSONResponse({"error": str(exc)}, status_code=exc.status_code)
+
+
+class ProfileRequests:
+    """
+    Opt-in sampling profile of a request (see PROFILE_* in config.py).
+    Covers the handler up to the response start: agent run, tools,
+    SQLAlchemy and the JSON response rendering. The profile is
+    process-wide, so concurrent requests appear in it as well (see
+    SamplingProfiler).
+
+    Plain ASGI rather than @app.middleware("http"): BaseHTTPMiddleware
+    wraps `receive` for every route, which hides client disconnects from
+    the handlers (see cancel_on_disconnect). Paths outside PROFILE_PATHS
+    are passed through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in PROFILE_PATHS:
+            return await self.app(scope, receive, send)
+        if not should_profile(scope["path"], Headers(scope=scope).get("X-Profile")):
+            return await self.app(scope, receive, send)
+        profiler = start_profiler()
+        if profiler is None:
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        name = None
+
+        async def finish():
+            # joins the sampler thread and writes the file: keep it off the loop
+            return await asyncio.to_thread(
+                finish_profiler, profiler, scope["method"], scope["path"], time.perf_counter() - start
+            )
+
+        async def send_with_name(message):
+            nonlocal name
+            if message["type"] == "http.response.start" and name is None:
+                name = await finish()
+                MutableHeaders(scope=message).append("X-Profile-Name", name)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_name)
+        finally:
+            if name is None:
+                await finish()
+
+
+app.add_middleware(ProfileRequests)
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None, alias="X-Admin-Token")):
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+async def cancel_on_disconnect(request: Request, coro):
+    """
+    Await `coro`, cancelling it if the client disconnects first (e.g. the
+    Streamlit client hit its timeout), so the server stops spending LLM
+    calls on an answer nobody will read. For requests with an
+    Idempotency-Key that holds until a write tool starts; after that
+    run_idempotent_async lets the run finish and stores its reply for the
+    retry.
+    """
+    task = asyncio.ensure_future(coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            metrics.incr("client_disconnects")
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return JSONResponse({"error": "client disconnected"}, status_code=499)
+
+
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
+
+class ExportRequest(BaseModel):
+    branches: list[str] | None = None
+    tables: list[str] | None = None
+
+
+@app.post("/export", dependencies=[Depends(require_admin)])
+def export(req: ExportRequest):
+    """
+    Incremental Parquet export of order_items and tool_calls (see export.py).
+    Sync on purpose: it reads in chunks and writes files, so it runs in
+    the thread pool rather than on the event loop.
+    """
+    try:
+        return run_export(branches=req.branches, tables=req.tables)
+    except ValueError as e:
+        return {"error": str(e)}
 
 
+@app.get("/debug/profiles", dependencies=[Depends(require_admin)])
+def debug_profiles():
+    return {"profiles": list_profiles()}
+
+
+@app.get("/debug/profiles/{name}", dependencies=[Depends(require_admin)])
+def debug_profile_download(name: str):
+    try:
+        path = profile_path(name)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return FileResponse(path, media_type="text/plain", filename=name)
+
+
+# Plain CRUD reads stay sync and run in the thread pool: under load the
+# aiosqlite versions were no faster and had a worse p99 (see bench.py)
 @app.get("/books")
 def list_books(db: Session = Depends(get_db)):
-    rows = db.execute(
-        text("SELECT isbn, title, author, price, stock FROM books")
-    ).mappings().all()
-    return [dict(r) for r in rows]
+    return list_books_db(db)
+
+@app.get("/books/similar")
+def similar_books(
+    q: Optional[str] = Query(None, description="Free-text description"),
+    isbn: Optional[str] = Query(None, description="Find books similar to this ISBN"),
+    k: int = Query(5, gt=0, le=50),
+    db: Session = Depends(get_db)
+):
+    # NumPy-bound, so this one stays sync and runs in the thread pool
+    try:
+        return similar_books_db(db, q=q, isbn=isbn, k=k)
+    except ValueError as e:
+        return {"error": str(e)}
+
+@app.get("/branches")
+def list_branches():
+    return {"branches": router.branches()}
+
+
+@app.get("/branches/search_books")
+def search_books_all_branches(
+    q: str = Query(..., description="Search text"),
+    by: str = Query("title", description="title or author"),
+):
+    return find_books_all_branches_db(q=q, by=by)
+
+
+@app.get("/branches/stock")
+def stock_across_branches(isbn: str = Query(...)):
+    try:
+        return stock_across_branches_db(isbn=isbn)
+    except ValueError as e:
+        return {"error": str(e)}
 
 @app.get("/search_books")
 def search_books(
@@ -62,34 +263,65 @@ def search_books(
     rows = find_books_db(db, q=q, by=by)
     return [dict(r) for r in rows]
 
+# Writes are async because they go through run_idempotent_async, like /chat
 @app.post("/create_order")
-def create_order(req: CreateOrderRequest, db: Session = Depends(get_db)):
-    try:
-        order_id = create_order_db(
-            db,
-            customer_id=req.customer_id,
-            items=[item.dict() for item in req.items]
-        )
-        return {"order_id": order_id}
-    except ValueError as e:
-        return {"error": str(e)}
+async def create_order(
+    req: CreateOrderRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    # the run may outlive this request (see run_idempotent_async), so it
+    # opens its own session instead of using a request-scoped one
+    async def run():
+        mark_written()
+        async with AsyncSessionLocal() as db:
+            try:
+                order_id = await create_order_db(
+                    db,
+                    customer_id=req.customer_id,
+                    items=[item.dict() for item in req.items]
+                )
+                return {"order_id": order_id}
+            except ValueError as e:
+                return {"error": str(e)}
+
+    return await run_idempotent_async("create_order", idempotency_key, req.dict(), run)
 
 @app.post("/restock_book")
-def restock_book(req: RestockRequest, db: Session = Depends(get_db)):
-    try:
-        new_stock = restock_book_db(db, isbn=req.isbn, qty=req.qty)
-        return {"isbn": req.isbn, "new_stock": new_stock}
-    except ValueError as e:
-        return {"error": str(e)}
+async def restock_book(
+    req: RestockRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    # the run may outlive this request (see run_idempotent_async), so it
+    # opens its own session instead of using a request-scoped one
+    async def run():
+        mark_written()
+        async with AsyncSessionLocal() as db:
+            try:
+                new_stock = await restock_book_db(db, isbn=req.isbn, qty=req.qty)
+                return {"isbn": req.isbn, "new_stock": new_stock}
+            except ValueError as e:
+                return {"error": str(e)}
+
+    return await run_idempotent_async("restock_book", idempotency_key, req.dict(), run)
 
 
 @app.post("/update_price")
-def update_price(req: UpdatePriceRequest, db: Session = Depends(get_db)):
-    try:
-        new_price = update_price_db(db, isbn=req.isbn, price=req.price)
-        return {"isbn": req.isbn, "new_price": new_price}
-    except ValueError as e:
-        return {"error": str(e)}
+async def update_price(
+    req: UpdatePriceRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    # the run may outlive this request (see run_idempotent_async), so it
+    # opens its own session instead of using a request-scoped one
+    async def run():
+        mark_written()
+        async with AsyncSessionLocal() as db:
+            try:
+                new_price = await update_price_db(db, isbn=req.isbn, price=req.price)
+                return {"isbn": req.isbn, "new_price": new_price}
+            except ValueError as e:
+                return {"error": str(e)}
+
+    return await run_idempotent_async("update_price", idempotency_key, req.dict(), run)
 
 
 @app.get("/order_status")
@@ -107,13 +339,30 @@ def inventory_summary(threshold: int = Query(5), db: Session = Depends(get_db)):
     return {"threshold": threshold, "low_stock": rows}
 
 @app.post("/chat")
-def chat(req: ChatRequest, db: Session = Depends(get_db)):
+async def chat(
+    req: ChatRequest,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
     """
     Free-form chat endpoint that uses the Library Agent + tools.
     """
-    reply = run_agent(
-        message=req.message,
-        session_id=req.session_id, 
-        db=db,                      
+    sid = req.session_id or "default"
+
+    async def run():
+        # budgets are part of the key: a caller with a tighter budget must
+        # not be handed a run that ignores it
+        reply = await _chat_flight.do(
+            (current_branch.get(), sid, req.message, req.max_seconds, req.max_steps),
+            lambda: arun_agent(
+                message=req.message,
+                session_id=req.session_id,
+                max_seconds=req.max_seconds,
+                max_steps=req.max_steps,
+            ),
+        )
+        return {"reply": reply}
+
+    return await cancel_on_disconnect(
+        request, run_idempotent_async("chat", idempotency_key, req.dict(), run)
     )
-    return {"reply": reply}
@@ -0,0 +1,15 @@
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+_counters = Counter()
+
+
+def incr(name: str, n: int = 1) -> None:
+    with _lock:
+        _counters[name] += n
+
+
+def snapshot() -> dict:
+    with _lock:
+        return dict(_counters)
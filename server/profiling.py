@@ -0,0 +1,172 @@
+import asyncio
+import collections
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from config import (
+    ADMIN_TOKEN,
+    PROFILE_SAMPLE_N,
+    PROFILE_PATHS,
+    PROFILE_INTERVAL,
+    PROFILE_DIR,
+    PROFILE_MAX_FILES,
+)
+
+
+# threads parked in these files are idle (thread pool workers, selectors)
+_IDLE_FILES = ("threading.py", "queue.py", "selectors.py")
+_NAME_RE = re.compile(r"^[\w.-]+\.folded$")
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler. A background thread snapshots every
+    other thread's Python stack each `interval` seconds, so the request
+    itself runs uninstrumented. Output is collapsed stacks
+    ("thread;outer;...;inner count"), which flamegraph.pl and speedscope
+    both read.
+
+    Profiles are process-wide: stacks can't be attributed to a request,
+    so everything else the process runs meanwhile (other requests, thread
+    pool work, idle-shard eviction) shows up too. Event-loop samples get
+    the running task's name after the thread name ("MainThread;Task-42;..."),
+    which keeps concurrent coroutines apart in the flame graph.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._loop = None
+        self._loop_ident = None
+
+    def start(self):
+        try:
+            self._loop = asyncio.get_running_loop()
+            self._loop_ident = threading.get_ident()
+        except RuntimeError:
+            pass
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or os.path.basename(frame.f_code.co_filename) in _IDLE_FILES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                if ident == self._loop_ident:
+                    # racy against the frame snapshot, which is fine for sampling
+                    task = asyncio.current_task(self._loop)
+                    if task is not None:
+                        stack.append(task.get_name())
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.counts.most_common())
+
+
+# one profile at a time: the sampler sees every thread, so overlapping
+# profiles would double the overhead and show the same stacks twice
+_active = threading.Lock()
+
+
+def is_admin_token(value: str | None) -> bool:
+    """Constant-time check of a header against ADMIN_TOKEN (never true if unset)."""
+    if not ADMIN_TOKEN or value is None:
+        return False
+    return hmac.compare_digest(value.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def should_profile(path: str, profile_header: str | None) -> bool:
+    if path not in PROFILE_PATHS:
+        return False
+    if is_admin_token(profile_header):
+        return True
+    return PROFILE_SAMPLE_N > 0 and random.randrange(PROFILE_SAMPLE_N) == 0
+
+
+def start_profiler():
+    """Returns a running profiler, or None if another profile is in progress."""
+    if not _active.acquire(blocking=False):
+        return None
+    profiler = SamplingProfiler()
+    profiler.start()
+    return profiler
+
+
+def finish_profiler(profiler: SamplingProfiler, method: str, path: str, seconds: float) -> str:
+    try:
+        profiler.stop()
+    finally:
+        _active.release()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    now = time.time()
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.localtime(now)) + f"-{int(now * 1000) % 1000:03d}"
+    slug = path.strip("/").replace("/", ".") or "root"
+    name = f"{stamp}_{method}_{slug}_{int(seconds * 1000)}ms.folded"
+    with open(os.path.join(PROFILE_DIR, name), "w", encoding="utf-8") as f:
+        f.write(profiler.collapsed())
+    _trim()
+    return name
+
+
+def _trim():
+    files = sorted(f for f in os.listdir(PROFILE_DIR) if _NAME_RE.match(f))
+    for old in files[:-PROFILE_MAX_FILES] if PROFILE_MAX_FILES > 0 else []:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles() -> list[dict]:
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    out = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not _NAME_RE.match(name):
+            continue
+        stamp, method, rest = name[:-len(".folded")].split("_", 2)
+        slug, _, ms = rest.rpartition("_")
+        out.append({
+            "name": name,
+            "created": stamp,
+            "method": method,
+            "path": "/" + slug.replace(".", "/"),
+            "duration_ms": int(ms.rstrip("ms")),
+            "size": os.path.getsize(os.path.join(PROFILE_DIR, name)),
+        })
+    return out
+
+
+def profile_path(name: str) -> str:
+    if not _NAME_RE.match(name):
+        raise ValueError(f"Profile {name} not found")
+    path = os.path.join(PROFILE_DIR, name)
+    if not os.path.exists(path):
+        raise ValueError(f"Profile {name} not found")
+    return path
@@ -0,0 +1,221 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+from config import (
+    DATABASE_URL,
+    ASYNC_DATABASE_URL,
+    DB_PATH,
+    DEFAULT_BRANCH,
+    BRANCHES_DIR,
+    SHARD_MAP,
+    SHARD_IDLE_TIMEOUT,
+    SCHEMA_PATH,
+)
+
+
+# Branch the current request is routed to. Set once per request (see
+# main.py) and read by SessionLocal(), so the *_db helpers and the agent
+# tools do not need a branch argument.
+current_branch: ContextVar[str] = ContextVar("current_branch", default=DEFAULT_BRANCH)
+
+_BRANCH_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+# async engine disposals in flight, kept so the futures aren't dropped
+_disposals = set()
+
+
+class _Shard:
+    def __init__(self, engine, async_url: str):
+        self.engine = engine
+        self.sessionmaker = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+        self.async_url = async_url
+        self.async_engine = None
+        self.async_sessionmaker = None
+        self.loop = None
+        self.last_used = time.monotonic()
+
+    def ensure_async(self):
+        """Called from a coroutine; the engine stays bound to that loop."""
+        if self.async_engine is None:
+            self.loop = asyncio.get_running_loop()
+            self.async_engine = create_async_engine(self.async_url)
+            self.async_sessionmaker = async_sessionmaker(
+                bind=self.async_engine, autoflush=False, expire_on_commit=False
+            )
+
+    def dispose(self):
+        """
+        Safe from any thread. aiosqlite connections must be closed on the
+        loop that opened them, so the async dispose is handed to that loop.
+        """
+        self.engine.dispose()
+        if self.async_engine is None:
+            return
+        if self.loop is not None and not self.loop.is_closed():
+            fut = asyncio.run_coroutine_threadsafe(self.async_engine.dispose(), self.loop)
+            _disposals.add(fut)
+            fut.add_done_callback(_disposals.discard)
+        else:
+            # the loop is gone and its connections with it; drop the pool
+            self.async_engine.sync_engine.dispose(close=False)
+
+
+class ShardRouter:
+    """
+    Maps a branch_id to its own SQLite file and engine. Engines are opened
+    lazily on first use and disposed after SHARD_IDLE_TIMEOUT seconds
+    without a new session, so hundreds of branches don't keep hundreds of
+    connection pools open.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shards: dict[str, _Shard] = {}
+        self._last_eviction = time.monotonic()
+
+    def db_path(self, branch_id: str) -> str:
+        if not _BRANCH_RE.match(branch_id or ""):
+            raise ValueError(f"Invalid branch id {branch_id!r}")
+        if branch_id == DEFAULT_BRANCH:
+            return DB_PATH
+        if branch_id in SHARD_MAP:
+            return SHARD_MAP[branch_id].replace("\\", "/")
+        return os.path.join(BRANCHES_DIR, f"{branch_id}.db").replace("\\", "/")
+
+    def _url(self, branch_id: str) -> str:
+        if branch_id == DEFAULT_BRANCH:
+            return DATABASE_URL
+        return f"sqlite:///{self.db_path(branch_id)}"
+
+    def _async_url(self, branch_id: str) -> str:
+        if branch_id == DEFAULT_BRANCH:
+            return ASYNC_DATABASE_URL
+        return f"sqlite+aiosqlite:///{self.db_path(branch_id)}"
+
+    def branches(self) -> list[str]:
+        """Branches that can actually be opened (valid id, file present)."""
+        found = {DEFAULT_BRANCH}
+        for branch_id in SHARD_MAP:
+            if _BRANCH_RE.match(branch_id) and self.exists(branch_id):
+                found.add(branch_id)
+        if os.path.isdir(BRANCHES_DIR):
+            for name in os.listdir(BRANCHES_DIR):
+                stem, ext = os.path.splitext(name)
+                # skip files SHARD_MAP has pointed elsewhere (or at nothing)
+                if (
+                    ext == ".db"
+                    and _BRANCH_RE.match(stem)
+                    and self.db_path(stem) == os.path.join(BRANCHES_DIR, name).replace("\\", "/")
+                    and self.exists(stem)
+                ):
+                    found.add(stem)
+        return sorted(found)
+
+    def exists(self, branch_id: str) -> bool:
+        if branch_id == DEFAULT_BRANCH:
+            return True
+        return os.path.exists(self.db_path(branch_id))
+
+    def _shard(self, branch_id: str) -> _Shard:
+        with self._lock:
+            shard = self._shards.get(branch_id)
+            if shard is None:
+                if not self.exists(branch_id):
+                    raise ValueError(f"Branch {branch_id} not found")
+                url = self._url(branch_id)
+                shard = _Shard(
+                    create_engine(
+                        url,
+                        connect_args={"check_same_thread": False} if "sqlite" in url else {}
+                    ),
+                    self._async_url(branch_id),
+                )
+                self._shards[branch_id] = shard
+            shard.last_used = time.monotonic()
+        self._maybe_evict()
+        return shard
+
+    def engine(self, branch_id: str):
+        return self._shard(branch_id).engine
+
+    def session(self, branch_id: str):
+        return self._shard(branch_id).sessionmaker()
+
+    def async_session(self, branch_id: str):
+        shard = self._shard(branch_id)
+        with self._lock:
+            shard.ensure_async()
+        return shard.async_sessionmaker()
+
+    def _maybe_evict(self):
+        now = time.monotonic()
+        if now - self._last_eviction < SHARD_IDLE_TIMEOUT / 4:
+            return
+        self._last_eviction = now
+        self.evict_idle(now)
+
+    def evict_idle(self, now: float | None = None) -> int:
+        """
+        Dispose engines idle for longer than SHARD_IDLE_TIMEOUT. Connections
+        still checked out finish normally and are closed when returned.
+        The default branch is kept open.
+        """
+        now = now or time.monotonic()
+        with self._lock:
+            idle = [
+                b for b, s in self._shards.items()
+                if b != DEFAULT_BRANCH and now - s.last_used > SHARD_IDLE_TIMEOUT
+            ]
+            evicted = [self._shards.pop(b) for b in idle]
+        for shard in evicted:
+            shard.dispose()
+        return len(evicted)
+
+    def create_branch(self, branch_id: str) -> str:
+        """Create the SQLite file for a new branch from db/schema.sql."""
+        path = self.db_path(branch_id)
+        if os.path.exists(path):
+            raise ValueError(f"Branch {branch_id} already exists")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
+            schema = f.read()
+        engine = create_engine(f"sqlite:///{path}")
+        try:
+            raw = engine.raw_connection()
+            try:
+                raw.executescript(schema)
+                raw.commit()
+            finally:
+                raw.close()
+        finally:
+            engine.dispose()
+        return path
+
+
+router = ShardRouter()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage library branch shards.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="list branches")
+    create = sub.add_parser("create", help="create an empty branch database from db/schema.sql")
+    create.add_argument("branch_id")
+    opts = parser.parse_args()
+
+    if opts.command == "list":
+        for branch_id in router.branches():
+            print(f"{branch_id}\t{router.db_path(branch_id)}")
+    else:
+        print(f"Created branch {opts.branch_id} at {router.create_branch(opts.branch_id)}")
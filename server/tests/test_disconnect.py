@@ -0,0 +1,116 @@
+import asyncio
+import socket
+import threading
+import time
+
+import httpx
+import pytest
+import uvicorn
+
+import agent
+import idempotency
+import main
+import metrics
+
+
+class _SlowExecutor:
+    """Stands in for agent_executor: optionally starts a write, then thinks for a while."""
+
+    def __init__(self, seconds: float, write: bool = False):
+        self.seconds = seconds
+        self.write = write
+
+    async def astream(self, inputs):
+        if self.write:
+            idempotency.mark_written()
+        await asyncio.sleep(self.seconds)
+        yield {"output": "done"}
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(agent, "asave_message", _noop)
+    monkeypatch.setattr(agent, "asave_tool_call", _noop)
+    monkeypatch.setattr(main, "DISCONNECT_POLL_INTERVAL", 0.05)
+
+    finished = []
+
+    async def reserve(endpoint, key, request_hash):
+        return None, 1.0
+
+    async def finish(endpoint, key, token, response):
+        finished.append((key, response))
+
+    monkeypatch.setattr(idempotency, "_areserve", reserve)
+    monkeypatch.setattr(idempotency, "_afinish", finish)
+
+    with metrics._lock:
+        metrics._counters.clear()
+
+    port = _free_port()
+    srv = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=srv.run, daemon=True)
+    thread.start()
+    while not srv.started:
+        time.sleep(0.01)
+    yield f"http://127.0.0.1:{port}", finished
+    srv.should_exit = True
+    thread.join(5)
+
+
+def _chat_and_hang_up(url: str, headers: dict | None = None):
+    with pytest.raises(httpx.ReadTimeout):
+        httpx.post(f"{url}/chat", json={"message": "hi"}, headers=headers, timeout=0.3)
+
+
+def _wait_for(predicate, timeout: float = 3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_disconnect_cancels_agent_run(server, monkeypatch):
+    url, finished = server
+    monkeypatch.setattr(agent, "agent_executor", _SlowExecutor(seconds=5))
+
+    _chat_and_hang_up(url)
+
+    assert _wait_for(lambda: metrics.snapshot().get("agent_runs_abandoned") == 1)
+    assert metrics.snapshot()["client_disconnects"] == 1
+    assert finished == []
+
+
+def test_disconnect_cancels_keyed_run_before_any_write(server, monkeypatch):
+    url, finished = server
+    monkeypatch.setattr(agent, "agent_executor", _SlowExecutor(seconds=5))
+
+    _chat_and_hang_up(url, {"Idempotency-Key": "k1"})
+
+    assert _wait_for(lambda: metrics.snapshot().get("agent_runs_abandoned") == 1)
+    # the key is released, so the retry runs the agent again
+    assert _wait_for(lambda: finished == [("k1", None)])
+
+
+def test_disconnect_keeps_keyed_run_that_wrote(server, monkeypatch):
+    url, finished = server
+    monkeypatch.setattr(agent, "agent_executor", _SlowExecutor(seconds=1, write=True))
+
+    _chat_and_hang_up(url, {"Idempotency-Key": "k2"})
+
+    # the run finishes and its reply is stored for the retry
+    assert _wait_for(lambda: finished == [("k2", {"reply": "done"})])
+    assert metrics.snapshot()["client_disconnects"] == 1
+    assert "agent_runs_abandoned" not in metrics.snapshot()
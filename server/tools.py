@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from langchain.tools import tool
 
 from db import (
@@ -9,7 +9,9 @@ from db import (
     update_price_db,
     order_status_db,
     inventory_summary_db,
+    stock_across_branches_db,
 )
+from vector_index import similar_books_db
 
 
 def _get_db():
@@ -112,6 +114,31 @@ def inventory_summary_tool(threshold: int = 5) -> dict:
         db.close()
 
 
+@tool("similar_books")
+def similar_books_tool(q: Optional[str] = None, isbn: Optional[str] = None, k: int = 5) -> list:
+    """
+    Find books semantically similar to a description or to an existing book.
+    q: free-text description (e.g. "distributed systems internals").
+    isbn: isbn of a book to find similar ones to.
+    k: how many books to return (default 5).
+    """
+    db = SessionLocal()
+    try:
+        return similar_books_db(db, q=q, isbn=isbn, k=k)
+    finally:
+        db.close()
+
+
+@tool("stock_across_branches")
+def stock_across_branches_tool(isbn: str) -> dict:
+    """
+    Get the stock of a book in every library branch.
+    isbn: book isbn.
+    Returns total_stock and per-branch stock and price.
+    """
+    return stock_across_branches_db(isbn=isbn)
+
+
 TOOLS = [
     find_books_tool,
     create_order_tool,
@@ -119,4 +146,6 @@ TOOLS = [
     update_price_tool,
     order_status_tool,
     inventory_summary_tool,
+    similar_books_tool,
+    stock_across_branches_tool,
 ]
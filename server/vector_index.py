@@ -0,0 +1,404 @@
+import hashlib
+import importlib
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from config import (
+    DEFAULT_BRANCH,
+    VECTOR_INDEX_PATH,
+    EMBEDDING_DIM,
+    EMBEDDER,
+    VECTOR_SYNC_INTERVAL,
+    IVF_MIN_ROWS,
+    IVF_NPROBE,
+)
+from shards import router, current_branch
+
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """
+    Deterministic local embedder (no network, no model download).
+    Words and character trigrams are hashed into a fixed number of buckets
+    with a signed count, then the vector is L2-normalised.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, s: str) -> list[str]:
+        words = _TOKEN_RE.findall(s.lower())
+        feats = [f"w:{w}" for w in words]
+        for w in words:
+            padded = f"#{w}#"
+            feats.extend(f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2))
+        return feats
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, s in enumerate(texts):
+            feats = self._features(s)
+            if not feats:
+                continue
+            digests = [
+                int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+                for f in feats
+            ]
+            h = np.array(digests, dtype=np.uint64)
+            idx = (h % np.uint64(self.dim)).astype(np.int64)
+            sign = np.where((h >> np.uint64(63)) == 0, 1.0, -1.0).astype(np.float32)
+            np.add.at(out[row], idx, sign)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+def _load_embedder():
+    """
+    EMBEDDER="package.module:factory" plugs in another embedder. The object
+    must expose `name`, `dim` and `embed(texts) -> np.ndarray`.
+    """
+    if not EMBEDDER:
+        return HashingEmbedder()
+    module_name, _, attr = EMBEDDER.partition(":")
+    factory = getattr(importlib.import_module(module_name), attr)
+    return factory()
+
+
+def book_text(row) -> str:
+    return f"{row['title']} {row['author']}"
+
+
+def _fingerprint(embedder_name: str, s: str) -> str:
+    return hashlib.sha1(f"{embedder_name}\x00{s}".encode("utf-8")).hexdigest()
+
+
+def _kmeans(vectors: np.ndarray, nlist: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = vectors[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids /= norms
+    return centroids.astype(np.float32)
+
+
+class VectorIndex:
+    """
+    Book embeddings stored next to library.db:
+      <path>.json              isbns + per-book fingerprints, same row order,
+                               and the generation of the array files below
+      <path>.<gen>.npy         float32 matrix (n_books, dim), opened memory-mapped
+      <path>.<gen>.ivf.npy     optional IVF centroids (large catalogs only)
+      <path>.<gen>.assign.npy  optional IVF list assignment per row
+    Every sync writes a new generation, so searches keep reading the
+    previous one until it is swapped in.
+    """
+
+    def __init__(self, path: str = VECTOR_INDEX_PATH, embedder=None):
+        self.path = path
+        self.embedder = embedder or _load_embedder()
+        self.isbns: list[str] = []
+        self.fingerprints: list[str] = []
+        self.vectors = np.zeros((0, self.embedder.dim), dtype=np.float32)
+        self.centroids = None
+        self.assign = None
+        self.generation = 0
+        self._rows: dict[str, int] = {}
+        # _lock only guards swapping the fields above; _sync_lock keeps
+        # syncs from running twice and is never taken by search()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._last_sync = 0.0
+        self._load()
+
+    def _file(self, suffix: str, generation: int | None = None) -> str:
+        if generation is None:
+            return f"{self.path}{suffix}"
+        return f"{self.path}.{generation}{suffix}"
+
+    def _load(self):
+        meta_path = self._file(".json")
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        generation = meta.get("generation")
+        if meta.get("embedder") != self.embedder.name or generation is None:
+            return
+        if not os.path.exists(self._file(".npy", generation)):
+            return
+        vectors = np.load(self._file(".npy", generation), mmap_mode="r")
+        centroids = assign = None
+        if meta.get("ivf") and os.path.exists(self._file(".ivf.npy", generation)):
+            centroids = np.load(self._file(".ivf.npy", generation))
+            assign = np.load(self._file(".assign.npy", generation), mmap_mode="r")
+
+        # files out of step with the .json (e.g. edited by hand); start
+        # empty so the next sync re-embeds everything
+        n = len(meta["isbns"])
+        if (
+            vectors.ndim != 2
+            or vectors.shape != (n, self.embedder.dim)
+            or len(meta["fingerprints"]) != n
+            or (assign is not None and len(assign) != n)
+        ):
+            return
+
+        self.isbns = meta["isbns"]
+        self.fingerprints = meta["fingerprints"]
+        self.vectors = vectors
+        self.centroids, self.assign = centroids, assign
+        self.generation = generation
+        self._rows = {isbn: i for i, isbn in enumerate(self.isbns)}
+
+    def _save_array(self, path: str, arr: np.ndarray):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp, path)
+
+    def _save(self, generation: int, isbns, fingerprints, vectors, centroids, assign):
+        """
+        Write a complete generation, then point the .json at it. Returns
+        the arrays re-opened from disk (memory-mapped).
+        """
+        self._save_array(self._file(".npy", generation), vectors)
+        if centroids is not None:
+            self._save_array(self._file(".ivf.npy", generation), centroids)
+            self._save_array(self._file(".assign.npy", generation), assign)
+
+        meta = {
+            "embedder": self.embedder.name,
+            "dim": self.embedder.dim,
+            "generation": generation,
+            "isbns": isbns,
+            "fingerprints": fingerprints,
+            "ivf": centroids is not None,
+        }
+        tmp = self._file(".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._file(".json"))
+
+        vectors = np.load(self._file(".npy", generation), mmap_mode="r")
+        if centroids is not None:
+            assign = np.load(self._file(".assign.npy", generation), mmap_mode="r")
+        return vectors, centroids, assign
+
+    def _drop_old_generations(self, keep: int):
+        folder, base = os.path.split(self.path)
+        pattern = re.compile(re.escape(base) + r"\.(\d+)\.(npy|ivf\.npy|assign\.npy)$")
+        for name in os.listdir(folder or "."):
+            m = pattern.match(name)
+            if m and int(m.group(1)) != keep:
+                try:
+                    os.remove(os.path.join(folder, name))
+                except OSError:
+                    # still mapped by a search (Windows); removed next time
+                    pass
+
+    def sync(self, db: Session, force: bool = False, rebuild: bool = False) -> int:
+        """
+        Bring the index in line with the books table. Only new books and
+        books whose title/author changed are re-embedded (in one batch);
+        deleted books are dropped. New and changed books join the nearest
+        existing IVF list; the lists are trained only by a `rebuild`.
+        Returns the number of embedded rows.
+
+        The table scan, embedding and file writes run without holding the
+        lock search() needs. A query that finds a sync already running
+        doesn't wait for it and searches the current generation.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_sync < VECTOR_SYNC_INTERVAL:
+            return 0
+        if not self._sync_lock.acquire(blocking=force):
+            return 0
+        try:
+            self._last_sync = now
+            with self._lock:
+                old_isbns, old_fingerprints = self.isbns, self.fingerprints
+                old_vectors, centroids, old_assign = self.vectors, self.centroids, self.assign
+                generation = self.generation
+
+            rows = db.execute(
+                text("SELECT isbn, title, author FROM books ORDER BY isbn")
+            ).mappings().all()
+
+            existing = {
+                isbn: (i, fp) for i, (isbn, fp) in enumerate(zip(old_isbns, old_fingerprints))
+            }
+            isbns, fingerprints, keep_rows, todo = [], [], [], []
+            for r in rows:
+                s = book_text(r)
+                fp = _fingerprint(self.embedder.name, s)
+                isbns.append(r["isbn"])
+                fingerprints.append(fp)
+                old = existing.get(r["isbn"])
+                if old is not None and old[1] == fp:
+                    keep_rows.append(old[0])
+                else:
+                    keep_rows.append(-1)
+                    todo.append((len(isbns) - 1, s))
+
+            if not todo and isbns == old_isbns and not rebuild:
+                return 0
+
+            vectors = np.zeros((len(isbns), self.embedder.dim), dtype=np.float32)
+            keep_rows = np.array(keep_rows, dtype=np.int64)
+            kept = keep_rows >= 0
+            if kept.any():
+                vectors[kept] = old_vectors[keep_rows[kept]]
+            positions = [p for p, _ in todo]
+            if todo:
+                vectors[positions] = self.embedder.embed([s for _, s in todo])
+
+            assign = None
+            if rebuild:
+                centroids = None
+                if len(vectors) >= IVF_MIN_ROWS:
+                    centroids = _kmeans(vectors, nlist=max(1, int(np.sqrt(len(vectors)))))
+                    assign = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+            elif centroids is not None:
+                assign = np.zeros(len(isbns), dtype=np.int32)
+                if kept.any():
+                    assign[kept] = old_assign[keep_rows[kept]]
+                if todo:
+                    assign[positions] = np.argmax(vectors[positions] @ centroids.T, axis=1)
+
+            vectors, centroids, assign = self._save(
+                generation + 1, isbns, fingerprints, vectors, centroids, assign
+            )
+            rows_by_isbn = {isbn: i for i, isbn in enumerate(isbns)}
+            with self._lock:
+                self.isbns, self.fingerprints, self._rows = isbns, fingerprints, rows_by_isbn
+                self.vectors, self.centroids, self.assign = vectors, centroids, assign
+                self.generation = generation + 1
+            self._drop_old_generations(keep=generation + 1)
+            return len(todo)
+        finally:
+            self._sync_lock.release()
+
+    def search(self, query: np.ndarray, k: int = 5, exclude: set[str] | None = None) -> list[tuple[str, float]]:
+        with self._lock:
+            isbns, vectors, rows = self.isbns, self.vectors, self._rows
+            centroids, assign = self.centroids, self.assign
+        if not isbns:
+            return []
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+
+        if centroids is not None:
+            nprobe = min(IVF_NPROBE, len(centroids))
+            probe = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+            candidates = np.flatnonzero(np.isin(assign, probe))
+        else:
+            candidates = np.arange(len(isbns))
+
+        if exclude:
+            excluded = [rows[i] for i in exclude if i in rows]
+            if excluded:
+                candidates = candidates[np.isin(candidates, excluded, invert=True)]
+        if len(candidates) == 0:
+            return []
+
+        scores = vectors[candidates] @ query
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(isbns[candidates[i]], float(scores[i])) for i in top]
+
+
+_indexes: dict[str, VectorIndex] = {}
+_index_lock = threading.Lock()
+
+
+def _index_path(branch_id: str) -> str:
+    if branch_id == DEFAULT_BRANCH:
+        return VECTOR_INDEX_PATH
+    return os.path.splitext(router.db_path(branch_id))[0] + ".vectors"
+
+
+def get_index() -> VectorIndex:
+    """Index for the branch the current request is routed to."""
+    branch_id = current_branch.get()
+    index = _indexes.get(branch_id)
+    if index is None:
+        with _index_lock:
+            index = _indexes.get(branch_id)
+            if index is None:
+                index = _indexes[branch_id] = VectorIndex(_index_path(branch_id))
+    return index
+
+
+def similar_books_db(db: Session, q: str | None = None, isbn: str | None = None, k: int = 5):
+    """
+    Semantic "books like this" search. Pass free text `q`, or an `isbn`
+    to find books similar to one already in the catalog.
+    """
+    index = get_index()
+    index.sync(db)
+
+    exclude = set()
+    if isbn:
+        book = db.execute(
+            text("SELECT isbn, title, author FROM books WHERE isbn = :isbn"),
+            {"isbn": isbn}
+        ).mappings().first()
+        if not book:
+            raise ValueError(f"Book {isbn} not found")
+        query_text = book_text(book)
+        exclude.add(isbn)
+    elif q:
+        query_text = q
+    else:
+        raise ValueError("Either q or isbn is required")
+
+    query = index.embedder.embed([query_text])[0]
+    hits = index.search(query, k=k, exclude=exclude)
+    if not hits:
+        return []
+
+    params = {f"i{n}": h[0] for n, h in enumerate(hits)}
+    placeholders = ", ".join(f":{p}" for p in params)
+    rows = db.execute(
+        text(f"SELECT isbn, title, author, price, stock FROM books WHERE isbn IN ({placeholders})"),
+        params
+    ).mappings().all()
+    by_isbn = {r["isbn"]: dict(r) for r in rows}
+
+    results = []
+    for h_isbn, score in hits:
+        if h_isbn in by_isbn:
+            results.append({**by_isbn[h_isbn], "score": round(score, 4)})
+    return results
+
+
+if __name__ == "__main__":
+    from db import SessionLocal
+
+    for branch_id in router.branches():
+        current_branch.set(branch_id)
+        db = SessionLocal()
+        try:
+            index = get_index()
+            n = index.sync(db, force=True, rebuild=True)
+            ivf = f", {len(index.centroids)} IVF lists" if index.centroids is not None else ""
+            print(f"[{branch_id}] Embedded {n} books into {_index_path(branch_id)}{ivf}")
+        finally:
+            db.close()